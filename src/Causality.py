@@ -2,13 +2,246 @@
 from tigramite import data_processing as pp
 from tigramite import plotting as tp
 from tigramite.pcmci import PCMCI
-from tigramite.independence_tests.parcorr import ParCorr
 from tigramite.models import LinearMediation
 from matplotlib import pyplot as plt
 import matplotlib as mpl 
 from yaml import safe_load
+from functools import lru_cache
+from copy import deepcopy
+import os
+from joblib import Parallel, delayed, effective_n_jobs
+from .FastParCorr import FastParCorr
 import numpy as np
-import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+###############################################
+@lru_cache(maxsize=1)
+def _load_config(path, mtime):
+    """_load_config
+
+    This function reads and parses the yaml configuration once per file version, 
+    repeated calls are served from memory until the file is modified.
+
+    Parameters
+    ----------
+    path : str
+        A path to the yaml file.
+    mtime : float
+        Modification time of the file, part of the cache key only.
+
+    Returns
+    -------
+    dict
+        Returns the parsed program configuration.
+    """
+    with open(path, 'r') as f:
+        config = safe_load(f)
+    return config
+
+###############################################
+def _screen_links(values, tau_min, tau_max, threshold):
+    """_screen_links
+
+    This function screens candidate causal links with lagged (Pearson) cross-correlations
+    computed for all pairs of indices at once via FFT. Links whose absolute
+    cross-correlation is below the threshold are excluded from PCMCI.
+    Auto-dependency links and links of constant indices (undefined correlation) are always kept.
+
+    Parameters
+    ----------
+    values : numpy array
+        Climate indices stacked column-wise, shape (T, N).
+    tau_min : int
+        Minimum time lag.
+    tau_max : int
+        Maximum time lag.
+    threshold : float
+        Minimum absolute cross-correlation of a link to be tested.
+
+    Returns
+    -------
+    dict
+        Link assumptions in Tigramite's format {j: {(i, -tau): link_type}}.
+    """
+
+    T, N = values.shape
+    std = values.std(axis=0)
+    const = std == 0
+    x = (values - values.mean(axis=0)) / np.where(const, 1.0, std)
+
+    # Zero padding to avoid circular wrap-around of the FFT-based correlation
+    n_fft = 1 << int(2 * T - 1).bit_length()
+    f = np.fft.rfft(x, n=n_fft, axis=0)
+
+    # xcorr[tau, i, j] = corr(x_i(t - tau), x_j(t))
+    xcorr = np.fft.irfft(np.conj(f)[:, :, None] * f[:, None, :], n=n_fft, axis=0)[:tau_max + 1]
+    xcorr /= (T - np.arange(tau_max + 1))[:, None, None]
+
+    link_assumptions = {}
+    for j in range(N):
+        link_assumptions[j] = {}
+        for i in range(N):
+            for tau in range(tau_min, tau_max + 1):
+                if i == j and tau == 0:
+                    continue
+                if i == j or const[i] or const[j] or abs(xcorr[tau, i, j]) >= threshold:
+                    link_assumptions[j][(i, -tau)] = 'o?o' if tau == 0 else '-?>'
+
+    return link_assumptions
+
+###############################################
+def _run_pcmci(dataframe, tau_min, tau_max, alpha_level, screen_threshold=0.0, mask_type=None):
+    """_run_pcmci
+
+    This function runs the PCMCI algorithm with the (fast) ParCorr test 
+    and extracts the causal graph from the p-values.
+
+    Parameters
+    ----------
+    dataframe : Dataframe
+        Tigramite's dataframe custom type.
+    tau_min : int
+        Minimum time lag.
+    tau_max : int
+        Maximum time lag.
+    alpha_level : float
+        Significance level.
+    screen_threshold : float, optional
+        Minimum absolute lagged cross-correlation of a link to be tested, by default 0.0 (no screening)
+    mask_type : str, optional
+        Which of the lagged X, Y, Z samples are removed by the dataframe's mask, by default None (mask not used)
+
+    Returns
+    -------
+    PCMCI
+        Tigramite's PCMCI object.
+    dict
+        Results of the PCMCI algorithm.
+    numpy array
+        The causal graph.
+    """
+
+    parcorr = FastParCorr(significance='analytic', mask_type=mask_type)
+
+    pcmci = PCMCI(dataframe=dataframe, cond_ind_test=parcorr, verbosity=0)
+
+    pcmci.verbosity = 0
+    
+    link_assumptions = None
+    if screen_threshold > 0.0:
+        values = dataframe.values[0]
+        if mask_type is not None:
+            values = values[~dataframe.mask[0].any(axis=1)]
+        link_assumptions = _screen_links(values, tau_min, tau_max, screen_threshold)
+
+    if link_assumptions is None:
+        results = pcmci.run_pcmci(tau_min=tau_min, tau_max=tau_max, pc_alpha=alpha_level, fdr_method='fdr_bh')
+    else:
+        # FDR correction must cover all candidate links, not only those that passed the screening
+        results = pcmci.run_pcmci(link_assumptions=link_assumptions, tau_min=tau_min, tau_max=tau_max, 
+                                  pc_alpha=alpha_level, fdr_method='none')
+        # Screened links keep p = 1 from run_mci, the unscreened link set (tau_min..tau_max) defines the tests
+        all_links = _screen_links(values, tau_min, tau_max, 0.0)
+        results['p_matrix'] = pcmci.get_corrected_pvalues(p_matrix=results['p_matrix'], tau_min=tau_min, tau_max=tau_max, 
+                                                          link_assumptions=all_links, fdr_method='fdr_bh')
+
+    graph = pcmci.get_graph_from_pmatrix(results['p_matrix'], alpha_level, tau_min, tau_max)
+    results['graph'] = graph
+
+    return pcmci, results, graph
+
+###############################################
+def _one_bootstrap(i, dataframe, tau_min, tau_max, alpha_level, n_mons, screen_threshold=0.0):
+    """_one_bootstrap
+
+    This function runs a single bootstrap iteration: it removes one year 
+    starting at time step i, builds the causal graph and fits the linear mediator.
+    It does not depend on any class state, so iterations can run in separate processes.
+
+    Parameters
+    ----------
+    i : int
+        The first time step of the removed year.
+    dataframe : Dataframe
+        Tigramite's dataframe custom type with a mask, the mask is overwritten in place.
+    tau_min : int
+        Minimum time lag.
+    tau_max : int
+        Maximum time lag.
+    alpha_level : float
+        Significance level.
+    n_mons : int
+        Number of months in one year.
+    screen_threshold : float, optional
+        Minimum absolute lagged cross-correlation of a link to be tested, by default 0.0 (no screening)
+
+    Returns
+    -------
+    numpy array
+        Path coeffs.
+    numpy array
+        Average causal effect of each index.
+    numpy array
+        Average causal susceptibility of each index.
+    """
+
+    # The data stay the same, masking the removed year drops every lagged sample
+    # whose time window overlaps it (no samples spanning the gap are created)
+    mask = dataframe.mask[0]
+    mask[:] = False
+    mask[i:i + n_mons] = True
+
+    # Compute causal links
+    pcmci, results, graph = _run_pcmci(dataframe, tau_min, tau_max, alpha_level, screen_threshold, mask_type='xyz')
+    sig_parents = pcmci.return_parents_dict(graph=graph, val_matrix=results['val_matrix'])
+
+    med = LinearMediation(dataframe=dataframe, mask_type = 'xyz', data_transform = None)
+    med.fit_model(all_parents = sig_parents, tau_max=tau_max)
+
+    val_matrix = med.get_val_matrix()
+
+    return val_matrix, med.get_all_ace(), med.get_all_acs()
+
+###############################################
+def _bootstrap_batch(inds, base_indices, var_names, tau_min, tau_max, alpha_level, n_mons, screen_threshold=0.0):
+    """_bootstrap_batch
+
+    This function runs a batch of bootstrap iterations reusing one dataframe
+    over all indices, iterations only change its mask.
+
+    Parameters
+    ----------
+    inds : numpy array
+        The first time steps of the removed years.
+    base_indices : numpy array
+        Climate indices stacked column-wise.
+    var_names : list of strings
+        Names of the indices.
+    tau_min : int
+        Minimum time lag.
+    tau_max : int
+        Maximum time lag.
+    alpha_level : float
+        Significance level.
+    n_mons : int
+        Number of months in one year.
+    screen_threshold : float, optional
+        Minimum absolute lagged cross-correlation of a link to be tested, by default 0.0 (no screening)
+
+    Returns
+    -------
+    list of tuples
+        Path coeffs, average causal effect and average causal susceptibility of each iteration.
+    """
+
+    T = base_indices.shape[0]
+    dataframe = pp.DataFrame(base_indices, mask=np.zeros(base_indices.shape, dtype=bool), 
+                             datatime = np.arange(T), var_names=var_names)
+
+    return [_one_bootstrap(i, dataframe, tau_min, tau_max, alpha_level, n_mons, screen_threshold) 
+            for i in inds]
 
 class Causality:
     """ Causality
@@ -37,16 +270,20 @@ class Causality:
         self.adjusted_val_matrix = None
         self.matched_labels=None
         
-        self.indexes = self.read_yaml_file()['indexes']
-        self.labels = self.read_yaml_file()['labels']
-
-        self.path = self.read_yaml_file()['path']
-        self.tau_min = self.read_yaml_file()['tau_min']
-        self.tau_max = self.read_yaml_file()['tau_max']
-        self.alpha_level = self.read_yaml_file()['significance_level']
-        self.save_path = self.read_yaml_file()['save_path']
-        self.range_months = self.read_yaml_file()['range_months']
-        self.boot_iter = int(self.read_yaml_file()['boot_iters'])
+        cfg = self.read_yaml_file()
+        self.indexes = cfg['indexes']
+        self.labels = cfg['labels']
+
+        self.path = cfg['path']
+        self.tau_min = cfg['tau_min']
+        self.tau_max = cfg['tau_max']
+        self.alpha_level = cfg['significance_level']
+        self.screen_threshold = float(cfg.get('screen_threshold', 0.0))
+        self.save_path = cfg['save_path']
+        self.range_months = cfg['range_months']
+        self.n_mons = self.range_months[1] - self.range_months[0] + 1
+        self.boot_iter = int(cfg['boot_iters'])
+        self.n_jobs = int(cfg.get('n_jobs', -1))
 
     ###############################################
     def read_yaml_file(self):
@@ -59,15 +296,16 @@ class Causality:
         A string of objects
             Returns a string of objects read fromt the yaml file.
         """
-        with open('config.yml', 'r') as f:
-            config = safe_load(f)
-        return config
+        path = os.path.abspath('config.yml')
+
+        # Copy so that instances do not share (and mutate) the cached dict
+        return deepcopy(_load_config(path, os.path.getmtime(path)))
     
     ###############################################
-    def generate_dataframe(self, D, rng=None):
-        """generate_dataframe 
+    def stack_indices(self, D):
+        """stack_indices 
 
-        This function generates dataframes in the common format for TIGRAMITE.
+        This function stacks climate indices into a single (time, index) array.
 
         Parameters
         ----------
@@ -76,32 +314,51 @@ class Causality:
 
         Returns
         -------
-        Dataframe
-            Tigramite's dataframe custom type.
         numpy array
+            Climate indices stacked column-wise.
+        list of strings
             A list of order indices names.
         """
-      
-        d_keys = list(D.keys())
-        matched_indexes = np.intersect1d(self.var_names, d_keys)
-        print('matched_indexes', matched_indexes)
-        print('var_names', self.var_names)
+
+        # Keep the order of var_names (np.intersect1d would sort the names)
+        matched_indexes = [k for k in self.var_names if k in D]
+        logger.debug('matched_indexes %s', matched_indexes)
+        logger.debug('var_names %s', self.var_names)
 
         CEN_labels = dict(map(lambda i,j : (i,j) , self.indexes, self.labels))
-        print(CEN_labels)
+        logger.debug('%s', CEN_labels)
         matched_labels = [CEN_labels[k] for k in matched_indexes]
-        print('matched_labels', matched_labels)
+        logger.debug('matched_labels %s', matched_labels)
         
         #self.var_names = matched_labels
         self.matched_labels = matched_labels
 
         dataset = [D[k].variables[k].values for k in matched_indexes]
         indices = np.vstack(dataset).transpose()
-        print('Input Indices:', indices.shape)
+        logger.debug('Input Indices: %s', indices.shape)
+
+        return indices, matched_labels
+
+    ###############################################
+    def generate_dataframe(self, D):
+        """generate_dataframe 
+
+        This function generates dataframes in the common format for TIGRAMITE.
 
-        if rng is not None:
-            indices = np.delete(indices, rng, axis=0)
-            print('bootstrap - reduced input: ', indices.shape)
+        Parameters
+        ----------
+        D : dict
+            A dictionary containing climate indices.
+
+        Returns
+        -------
+        Dataframe
+            Tigramite's dataframe custom type.
+        numpy array
+            A list of order indices names.
+        """
+      
+        indices, matched_labels = self.stack_indices(D)
 
         dataframe = pp.DataFrame(indices, datatime = np.arange(len(indices)), var_names=matched_labels)
 
@@ -127,21 +384,13 @@ class Causality:
             A dictionary containing statistically significant causal parents of each actor (index).
         """
 
-        parcorr = ParCorr(significance='analytic', mask_type=None)
-
-        pcmci = PCMCI(dataframe=dataframe, cond_ind_test=parcorr, verbosity=0)
-
-        pcmci.verbosity = 0
-        
-        results = pcmci.run_pcmci(tau_min=self.tau_min, tau_max=self.tau_max, pc_alpha=self.alpha_level, fdr_method='fdr_bh')
+        pcmci, results, self.graph = _run_pcmci(dataframe, self.tau_min, self.tau_max, self.alpha_level, self.screen_threshold)
 
         print('print_significant_links()')
         pcmci.print_significant_links(p_matrix=results['p_matrix'],
                                  val_matrix=results['val_matrix'],
                                  alpha_level=self.alpha_level)
 
-        self.graph = pcmci.get_graph_from_pmatrix(results['p_matrix'], self.alpha_level, self.tau_min, self.tau_max)
-
         sig_parents = pcmci.return_parents_dict(graph=self.graph, val_matrix=results['val_matrix'])
         print(sig_parents)
         
@@ -235,55 +484,60 @@ class Causality:
         """
 
         fig = plt.figure(figsize=(7, 5), frameon=False)
-        ax = fig.add_subplot(111, frame_on=False)
 
-        if save: 
-            path_name = self.save_path + 'cen' + "_".join(self.matched_labels)
-            print(path_name)
+        # Tigramite saves via pyplot, so the figure is registered there and must be closed
+        try:
+            ax = fig.add_subplot(111, frame_on=False)
+
+            if save: 
+                path_name = self.save_path + 'cen' + "_".join(self.matched_labels)
+                print(path_name)
             
-            # Replace negative autocorrelation path coefficients with their abs values.
-            val_matrix = self.change_main_diag(val_matrix)
-            self.adjusted_val_matrix = val_matrix
+                # Replace negative autocorrelation path coefficients with their abs values.
+                val_matrix = self.change_main_diag(val_matrix)
+                self.adjusted_val_matrix = val_matrix
             
-            tp.plot_graph(graph=self.graph, val_matrix=val_matrix, var_names=self.matched_labels, arrow_linewidth = 12, node_size=0.6, #node_size = 0.4, 
-                          node_label_size = 20, link_label_fontsize = 18, figsize=(10,8), curved_radius=0.2, 
-                          fig_ax=(fig,ax),
-                          node_aspect=0.99, edge_ticks=0.50, node_ticks=0.2,
-                          link_colorbar_label='Path coeff.', node_colorbar_label='Autocorr. path coeff.', label_fontsize=16, 
-                          show_colorbar=True, tick_label_size = 14,
-                          save_name=path_name,
-                          show_autodependency_lags=False,
-                          cmap_nodes = 'YlOrRd',
-                          vmin_edges=-1.0, vmax_edges=1.0, vmin_nodes=0.0, vmax_nodes=1.0)
-            plt.show()
-
-        else:
-            tp.plot_graph(graph=self.graph, val_matrix=val_matrix, var_names=self.var_names, 
-                          fig_ax=(fig,ax),
-                          link_colorbar_label='Path coeff.', node_colorbar_label='Autocorr. path coeff.', label_fontsize=14, show_colorbar=True,
-                          node_label_size = 16, link_label_fontsize = 16, cmap_nodes = 'YlOrRd',
-                          node_aspect=0.99)
-
-            plt.show()
+                tp.plot_graph(graph=self.graph, val_matrix=val_matrix, var_names=self.matched_labels, arrow_linewidth = 12, node_size=0.6, #node_size = 0.4, 
+                              node_label_size = 20, link_label_fontsize = 18, figsize=(10,8), curved_radius=0.2, 
+                              fig_ax=(fig,ax),
+                              node_aspect=0.99, edge_ticks=0.50, node_ticks=0.2,
+                              link_colorbar_label='Path coeff.', node_colorbar_label='Autocorr. path coeff.', label_fontsize=16, 
+                              show_colorbar=True, tick_label_size = 14,
+                              save_name=path_name,
+                              show_autodependency_lags=False,
+                              cmap_nodes = 'YlOrRd',
+                              vmin_edges=-1.0, vmax_edges=1.0, vmin_nodes=0.0, vmax_nodes=1.0)
+                plt.show()
+
+            else:
+                tp.plot_graph(graph=self.graph, val_matrix=val_matrix, var_names=self.var_names, 
+                              fig_ax=(fig,ax),
+                              link_colorbar_label='Path coeff.', node_colorbar_label='Autocorr. path coeff.', label_fontsize=14, show_colorbar=True,
+                              node_label_size = 16, link_label_fontsize = 16, cmap_nodes = 'YlOrRd',
+                              node_aspect=0.99)
+
+                plt.show()
+        finally:
+            plt.close(fig)
 
     ###############################################
     def get_links_beta_coeffs(self):
         """get_links_beta_coeffs 
 
-            This function returns beta coefficients for all causal links in CEN.
+            This function prints beta coefficients for all causal links in CEN.
+            It is meant for post-hoc inspection of a fitted model, not for the bootstrap loop.
+            Coefficients are indexed as [cause, effect, lag], missing links are zero
+            (the val matrix is filled into an array of zeros).
         """
 
         print('\n### Beta coefficients for:\n',)
 
-        names = self.var_names
-        n = int(len(names))
-        for v, i in zip(names, range(n)): print(i,v)
+        print("\n".join(f"{i} {v}" for i, v in enumerate(self.var_names)))
 
-        coeffs = self.linear_mediator.get_coefs()
-
-        df = pd.DataFrame(coeffs)
-        #df.fillna(0, inplace=True)
-        print(df)
+        # get_coefs() returns nested dicts of parents, the val matrix holds the same coeffs as an array
+        coeffs = self.linear_mediator.get_val_matrix()
+        with np.printoptions(precision=3, suppress=True):
+            print(coeffs)
         
     ###############################################
     def plot_time_series(self, dataframe):
@@ -299,7 +553,7 @@ class Causality:
             Output path., by default ''
         """
         
-        tp.plot_timeseries(
+        fig, _ = tp.plot_timeseries(
             dataframe,time_label='Monthly means', 
             figsize=(8,6), 
             skip_ticks_data_x = 2, 
@@ -308,6 +562,9 @@ class Causality:
             label_fontsize=16,
             save_name=self.save_path + 'timeseries_data_plot')
         
+        plt.show()
+        plt.close(fig)
+        
     ###############################################
     def generate_random_indices(self):
         """generate_random_indices _summary_
@@ -320,72 +577,73 @@ class Causality:
             _description_
         """
 
-        # Set for reproducibility of results
-        np.random.seed(113)
-
-        # Constant number of months
-        n_mons = len(list(range(self.range_months[0], self.range_months[1] + 1)))
+        # Local generator with a fixed seed for reproducibility of results
+        rng = np.random.default_rng(113)
 
         # Number of samples in one time series
         d_keys = list(self.D.keys())
         k = d_keys[0]
-        sample_size = list(range(0, self.D[k].variables[k].values.shape[0], n_mons))
-        print('Sample size:',sample_size)
+        sample_size = np.arange(0, self.D[k].variables[k].values.shape[0], self.n_mons)
+        logger.debug('Sample size: %s', sample_size)
 
         # Number of iteration of random sampling
         n_iter = self.boot_iter
 
         # Randomly sample indices (years) to remove from dataframe
         # This function should generate indices that start every 12 samples (months)
-        rnd_inds = np.random.choice(a=sample_size, size=n_iter, replace=True) 
-        print('Selected samples/years:',rnd_inds)
+        rnd_inds = rng.choice(a=sample_size, size=n_iter, replace=True) 
+        logger.debug('Selected samples/years: %s', rnd_inds)
 
         return rnd_inds
 
     ###############################################
-    def bootrstapping(self):
+    def bootrstapping(self, n_jobs=None):
         """bootrstapping 
 
         This function performs bootstrapping and measures average causal effect
         and average causal susceptibility metrics. It saves results of the bootstrapping
-        to a npz file.
+        to a npz file. Bootstrap iterations are independent and run in parallel.
+
+        Parameters
+        ----------
+        n_jobs : int, optional
+            Number of parallel jobs (joblib convention), by default None (n_jobs from the config file)
         """
 
-        all_val_matrices = []
-        all_ace = []
-        all_acs = []
+        if n_jobs is None: n_jobs = self.n_jobs
 
         rnd_inds = self.generate_random_indices()
 
-        for i, s in zip(rnd_inds, range(0, rnd_inds.shape[0])):
-            
-            print('ITERATION ', s, sep='\n')
+        # The input indices do not change between iterations, stack them only once
+        base_indices, labels = self.stack_indices(self.D)
 
-            # Generate data frames in the common format for TIGRAMITE
-            # Range of one year
-            n_mons = len(list(range(self.range_months[0], self.range_months[1] + 1)))
-            rng = list(range(i,i + n_mons))
-            print('Selected months:', rng)
-            
-            dataframe, labels = self.generate_dataframe(self.D, rng)
-            
-            # Compute causal links
-            sig_parents = self.construct_causal_graph(dataframe)
-            val_matrix = self.linear_estimator(sig_parents, dataframe)
- 
-            med = self.linear_mediator
-            val_matrix = med.get_val_matrix()
-            print('## Coefficient vals:\n', val_matrix)
-            
-            self.get_links_beta_coeffs()
+        # Preallocate contiguous arrays for results of all iterations
+        n_iter, n_vars = len(rnd_inds), len(labels)
+        all_val_matrices = np.empty((n_iter, n_vars, n_vars, self.tau_max + 1), dtype=np.float64)
+        all_ace = np.empty((n_iter, n_vars), dtype=np.float64)
+        all_acs = np.empty((n_iter, n_vars), dtype=np.float64)
+
+        # One batch of iterations per job, each batch reuses its own dataframe
+        batches = [b for b in np.array_split(rnd_inds, effective_n_jobs(n_jobs)) if len(b) > 0]
+        results = Parallel(n_jobs=n_jobs, backend='loky')(
+            delayed(_bootstrap_batch)(b, base_indices, labels, self.tau_min, self.tau_max, self.alpha_level, self.n_mons, self.screen_threshold) 
+            for b in batches)
+
+        # Diagnostics are logged here, loky workers do not inherit the logging configuration
+        for s, (val_matrix, ace, acs) in enumerate(r for batch in results for r in batch):
             
-            all_val_matrices.append(val_matrix)
+            logger.debug('ITERATION %d', s)
+            logger.debug('Selected months: %s', list(range(rnd_inds[s], rnd_inds[s] + self.n_mons)))
+            logger.debug('bootstrap - masked samples: %d', self.n_mons)
+            logger.debug('## Coefficient vals:\n%s', val_matrix)
+
+            all_val_matrices[s] = val_matrix
 
             # ACE and ACS metrics
-            all_ace.append(med.get_all_ace())
-            all_acs.append(med.get_all_acs())
-            print ("Average Causal Effect X=%.2f, Y=%.2f, Z=%.2f, Q=%.2f " % tuple(med.get_all_ace()))
-            print ("Average Causal Susceptibility X=%.2f, Y=%.2f, Z=%.2f, Q=%.2f " % tuple(med.get_all_acs()))
+            all_ace[s] = ace
+            all_acs[s] = acs
+            logger.debug("Average Causal Effect X=%.2f, Y=%.2f, Z=%.2f, Q=%.2f ", *ace)
+            logger.debug("Average Causal Susceptibility X=%.2f, Y=%.2f, Z=%.2f, Q=%.2f ", *acs)
             
         # Save to a file
         np.savez(self.path + 'bootstrap_results' + "_".join(self.var_names), 
@@ -394,4 +652,3 @@ class Causality:
                  coeffs=all_val_matrices, 
                  all_ace=all_ace, 
                  all_acs=all_acs)
-        